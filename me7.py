@@ -33,6 +33,11 @@ import time
 import logging
 import struct
 import copy
+import ast
+import mmap
+import binascii
+import os
+import tempfile
 
 # 3rd party
 import pylibftdi 
@@ -41,12 +46,42 @@ logger = logging.getLogger(__name__)
 
 # Commands
 StopCommunicating = 0x82
+ReadMemoryByAddress = 0x23
 WriteMemoryByAddress = 0x3d
 SetupLogging = 0xb7
 
+# Positive responses echo the command with this bit set.
+PositiveResponse = 0x40
+
+# Every frame has a single length byte, so at most 255 bytes can follow it.
+# A write also carries the command, a three byte address and a size byte,
+# and a read response carries the response code.
+MaxWriteSize = 0xff - 5
+MaxReadSize = 0xff - 1
+
+def _asbytes(buf):
+    """Returns `buf` unchanged if it's already bytes-like, otherwise
+    converts it from a list of ints to a bytearray. This lets the protocol
+    code work on bytes while still accepting the older list-of-ints form."""
+    if isinstance(buf, (bytes, bytearray, memoryview)):
+        return buf
+    return bytearray(buf)
+
+def _monotonic_ns_fallback():
+    """Returns time.monotonic in integer nanoseconds, for Python 3.6,
+    which has no time.monotonic_ns."""
+    return int(time.monotonic() * 1e9)
+
+# Chosen once here rather than checked on every call.
+_monotonic_ns = getattr(time, "monotonic_ns", _monotonic_ns_fallback)
+
 class Variable(object):
     #https://docs.python.org/2/library/struct.html#format-characters
     _struct_sizes = {1: "B", 2: "H"}
+    # Built once for each size rather than on every conversion. These are
+    # kept on the class so that Variables can still be pickled.
+    _structs = dict((size, struct.Struct(">" + fmt))
+        for size, fmt in _struct_sizes.items())
 
     def __init__(self, name, addr, size=1, unit="?", factor=1, bitmask=None,
         offset=0, signed=False, inverse=False, comment=None):
@@ -71,11 +106,14 @@ class Variable(object):
         self.raw_value = None
 
     def set(self, raw_value):
+        """Sets the raw value, from bytes, a bytearray, a memoryview or a
+        list of ints. It's stored as bytes, so it doesn't hold on to the
+        buffer it came from and the Variable can be pickled."""
         if len(raw_value) != self.size:
             raise ValueError("Wrong number of bytes (%d) for a variable"\
                 " of size %d", len(raw_value), self.size)
 
-        self.raw_value = raw_value
+        self.raw_value = bytes(raw_value)
 
     def get(self):
         if self.raw_value is None:
@@ -92,24 +130,21 @@ class Variable(object):
             )
 
     def _convert(self, raw_value):
-        """Convert from a list of bytes to the final signed/unsigned value."""
+        """Convert from bytes to the final signed/unsigned value."""
         # We could consider the signed/unsigned type here, but we have to do
         # the signed/unsigned conversion after the bitmask application so we
         # just assume unsigned for now.
-        value = struct.unpack(">" + self._struct_sizes[self.size], 
-            self._bytestr(raw_value))[0]
+        value = self._structs[self.size].unpack_from(_asbytes(raw_value))[0]
 
         # Apply bitmask.
         value &= self.bitmask
 
-        if self.signed:
-            fmt = ">" + self._struct_sizes[self.size]
-            # Convert the unsigned value into a signed value by byte-packing
-            # it as unsigned, and unpacking it as signed.
-            # The struct format characters for signed are lowercase, so just
-            # use .lower() to convert the format string.
-            value = struct.unpack(fmt.lower(), struct.pack(fmt, value))[0]
-        
+        sign_bit = 1 << (self.size * 8 - 1)
+        if self.signed and value & sign_bit:
+            # Convert the unsigned value into a two's complement signed
+            # value of the same size.
+            value -= sign_bit << 1
+
         if self.inverse:
             value = self.factor / (value - self.offset)
         else:
@@ -117,17 +152,672 @@ class Variable(object):
 
         return value
 
-    def _bytestr(self, values):
-        """Convert a list of ints representing bytes to a string."""
-        return "".join([chr(v) for v in values])
+
+class DerivedVariable(object):
+    """A value computed from other logged values, e.g. engine load from
+    airflow and RPM. `expression` is a Python arithmetic expression that
+    refers to other variables by name, such as "mshfm_w / nmot". The
+    expression is checked and compiled once, when the DerivedVariable is
+    created, so evaluating it per record is a single function call."""
+
+    # Functions that may be called from an expression.
+    _functions = {"abs": abs, "min": min, "max": max}
+
+    # AST node types allowed in an expression: arithmetic, comparisons,
+    # conditionals, names, constants and calls to the functions above.
+    _allowed_nodes = set([
+        "Expression", "BinOp", "UnaryOp", "BoolOp", "Compare", "IfExp",
+        "Call", "Name", "Load", "Num", "Constant",
+        "Add", "Sub", "Mult", "Div", "FloorDiv", "Mod", "Pow",
+        "USub", "UAdd", "Not", "And", "Or",
+        "Eq", "NotEq", "Lt", "LtE", "Gt", "GtE",
+        "BitAnd", "BitOr", "BitXor", "LShift", "RShift", "Invert",
+        ])
+
+    # Syntax that Python evaluates by truth-testing its operands, which
+    # raises for numpy arrays, so can't be evaluated over whole columns.
+    _scalar_nodes = set(["BoolOp", "IfExp", "Not"])
+    _scalar_functions = set(["min", "max"])
+
+    def __init__(self, name, expression, unit="?", comment=None):
+        self.name = name
+        self.expression = expression
+        self.unit = unit
+        self.comment = comment
+
+        self.inputs, self.vectorisable = self._parse(expression)
+        self._compile()
+
+        self.value = None
+
+    def _compile(self):
+        # Compile the expression as a function taking each input as a
+        # positional argument. Using the same function for single records
+        # and for whole columns means there's only one code path to trust.
+        source = "lambda %s: (%s)" % (", ".join(self.inputs), self.expression)
+        namespace = dict(self._functions)
+        namespace["__builtins__"] = {}
+        self._function = eval(compile(source,
+            "<me7.DerivedVariable %s>" % self.name, "eval"), namespace)
+
+    def __getstate__(self):
+        # The compiled function can't be pickled, so it's rebuilt from the
+        # expression instead.
+        state = self.__dict__.copy()
+        del state["_function"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def __copy__(self):
+        # Copies share the compiled function rather than going through
+        # __getstate__ and __setstate__, which would compile it again.
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        return copied
+
+    def _parse(self, expression):
+        """Checks that `expression` only uses permitted syntax. Returns a
+        tuple of the variable names it refers to, in order of first
+        appearance, and whether it can be evaluated over numpy arrays."""
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise ValueError("Invalid expression for %s: %s" % (
+                self.name, e))
+
+        names = []
+        vectorisable = True
+        for node in ast.walk(tree):
+            node_type = type(node).__name__
+            if node_type not in self._allowed_nodes:
+                raise ValueError("Unsupported syntax (%s) in expression"\
+                    " for %s" % (node_type, self.name))
+
+            if node_type in self._scalar_nodes:
+                vectorisable = False
+            elif node_type == "Compare" and len(node.ops) > 1:
+                # Chained comparisons are evaluated with an implicit "and".
+                vectorisable = False
+            elif node_type == "Call":
+                if type(node.func).__name__ != "Name" \
+                        or node.func.id not in self._functions:
+                    raise ValueError("Unsupported function call in"\
+                        " expression for %s" % self.name)
+                if node.func.id in self._scalar_functions:
+                    vectorisable = False
+            elif node_type in ("Num", "Constant"):
+                value = node.n if node_type == "Num" else node.value
+                if isinstance(value, complex) \
+                        or not isinstance(value, (int, float)):
+                    raise ValueError("Unsupported constant (%r) in"\
+                        " expression for %s" % (value, self.name))
+            elif node_type == "Name" and node.id not in self._functions:
+                names.append(node)
+
+        # ast.walk is breadth first, so sort by position in the expression
+        # to give the compiled function a predictable argument order.
+        names.sort(key=lambda node: (node.lineno, node.col_offset))
+        inputs = []
+        for node in names:
+            if node.id not in inputs:
+                inputs.append(node.id)
+        return tuple(inputs), vectorisable
+
+    def evaluate(self, values):
+        """Computes this variable from `values`, a dict keyed by variable
+        name whose values are Variables (as returned by getLogValues) or
+        plain numbers. Returns None if any input is missing or has no
+        value yet, or if the expression can't be computed for these values,
+        e.g. a division by zero or the square root of a negative number."""
+        args = []
+        for name in self.inputs:
+            value = values.get(name)
+            if hasattr(value, "get"):
+                value = value.get()
+            args.append(value)
+        return self._call(*args)
+
+    def _call(self, *args):
+        """Calls the compiled expression for a single record, returning None
+        rather than raising if an input is None or the arithmetic fails.
+        Complex results, e.g. from a fractional power of a negative number,
+        are treated as failures too."""
+        if None in args:
+            return None
+        try:
+            result = self._function(*args)
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+        if isinstance(result, complex):
+            return None
+        return result
+
+    def evaluateColumns(self, columns):
+        """Computes this variable for a batch of records at once. `columns`
+        is a dict keyed by variable name, each value being a sequence with
+        one plain number (or None) per record.
+
+        If every input column is a numpy array and the expression is
+        vectorisable, it's evaluated in a single call and an array is
+        returned. numpy's rules apply in that case, so e.g. a division by
+        zero gives inf or nan rather than None. Expressions using "and",
+        "or", "not", conditionals, chained comparisons, min or max aren't
+        vectorisable. Otherwise a list with one result per record is
+        returned, computed as evaluate() would.
+
+        numpy is optional, and only needed for the vectorised case. If an
+        input column is missing, every result is None, as evaluate() gives
+        for a missing input."""
+        records = len(next(iter(columns.values()))) if columns else 0
+        if any(name not in columns for name in self.inputs):
+            return [None] * records
+        args = [columns[name] for name in self.inputs]
+        if not args:
+            # A constant expression still gives one value per record.
+            return [self._call()] * records
+        if self.vectorisable \
+                and all(hasattr(arg, "__array__") for arg in args):
+            return self._function(*args)
+        return list(map(self._call, *args))
+
+    def evaluateBatch(self, records):
+        """Computes this variable for each dict in `records`, which are
+        in the same form accepted by evaluate(). Returns a list with one
+        result per record."""
+        return [self.evaluate(record) for record in records]
+
+    def get(self):
+        return self.value
+
+    def __repr__(self):
+        return "<me7.DerivedVariable: %s = %s %s (%s)>" % (
+                self.name
+            ,   self.get()
+            ,   self.unit
+            ,   self.comment
+            )
+
+
+class SamplePublisher(object):
+    """Publishes logged values into a ring buffer in a shared memory file,
+    so that any number of other processes can read the latest values or
+    recent history with SampleReader, without the records having to be
+    copied through sockets or serialised.
+
+    The layout is fixed when the publisher is created, from `variables`,
+    a list of the Variables (and DerivedVariables) that will be logged.
+    Every slot in the ring holds a timestamp followed by one double per
+    variable, in that order. The timestamp is in seconds on the
+    time.monotonic clock, taken from the record's sampled_ns when it's a
+    LogRecord. Missing values are stored as NaN.
+
+    Writes are protected by a sequence lock: the sequence number is odd
+    while a write is in progress, and readers retry if it was odd or
+    changed while they were reading.
+
+    The file is never resized or rewritten in place, since readers may
+    have it mapped. A new publisher builds its file under a temporary
+    name, marks any existing file at `path` as replaced, and renames the
+    new file over it. Readers notice the mark and reopen `path`."""
+
+    _magic = b"ME7P"
+    _version = 2
+
+    # magic, version, number of variables, ring capacity, schema length.
+    _header = struct.Struct("<4sHHII")
+    # Sequence lock counter, total number of samples published, and
+    # whether the file has been replaced by a newer publisher, each eight
+    # byte aligned.
+    _counter = struct.Struct("<Q")
+    _seq_offset = 16
+    _count_offset = 24
+    _replaced_offset = 32
+    _schema_offset = 40
+
+    def __init__(self, path, variables, capacity=1024):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least one sample")
+
+        self.path = path
+        self.names = [var.name for var in variables]
+        self.capacity = capacity
+
+        # The schema is one "name<tab>unit" line per variable, so neither
+        # can contain a tab or a newline.
+        for var in variables:
+            for field in (var.name, var.unit):
+                if "\t" in str(field) or "\n" in str(field):
+                    raise ValueError("Variable names and units can't"\
+                        " contain tabs or newlines: %r" % (field,))
+        schema = "\n".join("%s\t%s" % (var.name, var.unit)
+            for var in variables).encode("utf-8")
+
+        self._slot = struct.Struct("<%dd" % (len(self.names) + 1))
+        self._data_offset = self._align(self._schema_offset + len(schema))
+        size = self._data_offset + self._slot.size * capacity
+
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix=".me7-")
+        self._file = self._map = None
+        try:
+            # mkstemp makes the file private to this user, but readers may
+            # run as other users. Give it the permissions open() would.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.fchmod(fd, 0o666 & ~umask)
+
+            self._file = os.fdopen(fd, "w+b")
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+
+            self._header.pack_into(self._map, 0, self._magic, self._version,
+                len(self.names), capacity, len(schema))
+            self._map[self._schema_offset:self._schema_offset + len(schema)] \
+                = schema
+
+            self._markReplaced(path)
+            os.replace(temp_path, path)
+        except Exception:
+            if self._map is not None:
+                self._map.close()
+            if self._file is not None:
+                self._file.close()
+            else:
+                os.close(fd)
+            os.unlink(temp_path)
+            raise
+
+        self._seq = 0
+        self._count = 0
+
+    @classmethod
+    def _markReplaced(cls, path):
+        """Flags an existing sample buffer at `path`, if there is one, so
+        that readers still using it know to reopen `path`."""
+        try:
+            with open(path, "r+b") as f:
+                if os.fstat(f.fileno()).st_size < cls._schema_offset:
+                    return
+                m = mmap.mmap(f.fileno(), cls._schema_offset)
+                try:
+                    if m[:len(cls._magic)] == cls._magic:
+                        cls._counter.pack_into(m, cls._replaced_offset, 1)
+                finally:
+                    m.close()
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def _align(offset):
+        return (offset + 7) & ~7
+
+    def publish(self, values):
+        """Writes one sample to the ring. `values` is a dict keyed by
+        variable name, as returned by ECU.getLogValues."""
+        sampled_ns = getattr(values, "sampled_ns", None)
+        sample = [time.monotonic() if sampled_ns is None
+            else sampled_ns / 1e9]
+        for name in self.names:
+            value = values.get(name)
+            if hasattr(value, "get"):
+                value = value.get()
+            sample.append(float("nan") if value is None else value)
+
+        offset = self._data_offset \
+            + self._slot.size * (self._count % self.capacity)
+
+        self._seq += 1
+        self._counter.pack_into(self._map, self._seq_offset, self._seq)
+        self._slot.pack_into(self._map, offset, *sample)
+        self._count += 1
+        self._counter.pack_into(self._map, self._count_offset, self._count)
+        self._seq += 1
+        self._counter.pack_into(self._map, self._seq_offset, self._seq)
+
+    def close(self):
+        """Unmaps the ring buffer. The file is left in place for any
+        readers that still have it open."""
+        self._map.close()
+        self._file.close()
+
+
+class SampleReader(object):
+    """Reads samples written by a SamplePublisher in another process.
+    The variable names and units are read from the shared memory file,
+    so a reader doesn't need to know what is being logged. If a new
+    publisher replaces the file, the reader reopens it, and the names,
+    units and capacity may change.
+
+    A read that can't get a consistent view within `timeout` seconds,
+    e.g. because the publisher died mid-write, raises a RuntimeError."""
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped.
+            self._file.close()
+            raise ValueError("%s is not a compatible sample buffer"
+                % self.path)
+
+        try:
+            self._parse()
+        except:
+            self.close()
+            raise
+
+    def _parse(self):
+        """Reads and checks the header and schema of the mapped file."""
+        offset = SamplePublisher._schema_offset
+        if len(self._map) < offset:
+            raise ValueError("%s is not a compatible sample buffer"
+                % self.path)
+
+        magic, version, fields, self.capacity, schema_length = \
+            SamplePublisher._header.unpack_from(self._map, 0)
+        if magic != SamplePublisher._magic \
+                or version != SamplePublisher._version:
+            raise ValueError("%s is not a compatible sample buffer"
+                % self.path)
+
+        self._slot = struct.Struct("<%dd" % (fields + 1))
+        self._data_offset = SamplePublisher._align(offset + schema_length)
+        if len(self._map) < self._data_offset \
+                + self._slot.size * self.capacity:
+            raise ValueError("%s is truncated" % self.path)
+
+        schema = self._map[offset:offset + schema_length].decode("utf-8")
+        lines = [line.split("\t") for line in schema.split("\n")] \
+            if fields else []
+        self.names = [line[0] for line in lines]
+        self.units = dict(lines)
+
+    def _counter(self, offset):
+        return SamplePublisher._counter.unpack_from(self._map, offset)[0]
+
+    def _consistent(self, read):
+        """Calls `read` with the number of samples published so far, and
+        retries until it ran without the publisher writing concurrently."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self._counter(SamplePublisher._replaced_offset):
+                self.close()
+                self._open()
+
+            seq = self._counter(SamplePublisher._seq_offset)
+            if not seq & 1:
+                result = read(self._counter(SamplePublisher._count_offset))
+                if self._counter(SamplePublisher._seq_offset) == seq:
+                    return result
+
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for a consistent"\
+                    " sample from %s" % self.path)
+            if seq & 1:
+                # A write is in progress, give the publisher a chance to
+                # finish it.
+                time.sleep(0.0001)
+
+    def _sample(self, index):
+        offset = self._data_offset \
+            + self._slot.size * (index % self.capacity)
+        sample = self._slot.unpack_from(self._map, offset)
+        return sample[0], dict(zip(self.names, sample[1:]))
+
+    def latest(self):
+        """Returns a tuple of the timestamp and a dict of values, keyed by
+        variable name, for the most recent sample. Returns None if nothing
+        has been published yet."""
+        return self._consistent(
+            lambda count: self._sample(count - 1) if count else None)
+
+    def history(self, samples=None):
+        """Returns up to `samples` of the most recent samples, oldest first,
+        each as a (timestamp, values) tuple like latest(). By default
+        returns everything still held in the ring."""
+        if samples is None or samples > self.capacity:
+            samples = self.capacity
+
+        def read(count):
+            first = max(0, count - samples)
+            return [self._sample(index) for index in range(first, count)]
+
+        return self._consistent(read)
+
+    def count(self):
+        """Returns the total number of samples published so far."""
+        return self._consistent(lambda count: count)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class LogRecord(dict):
+    """The dict of Variables returned by ECU.getLogValues, with the times
+    the record was requested and received, and an estimate of when the ECU
+    sampled it. All are integer nanoseconds on the time.monotonic
+    clock, which doesn't jump with wall clock changes and is shared by all
+    processes on the machine."""
+
+    def __init__(self, sent_ns=None, received_ns=None, sampled_ns=None):
+        dict.__init__(self)
+        self.sent_ns = sent_ns
+        self.received_ns = received_ns
+        self.sampled_ns = sampled_ns
+
+
+class LogStatistics(object):
+    """Keeps rolling statistics for each logged value over the last
+    `window` seconds, without keeping the records themselves. Attach it
+    to an ECU with ecu.addLogListeners(stats.update).
+
+    The window is split into `buckets` time slices, each holding a count,
+    sum, minimum and maximum for every variable, so memory use doesn't
+    grow with the logging rate or session length. Statistics are accurate
+    to within one bucket's width of the window edge.
+
+    Percentiles need a histogram, configured per variable in `histograms`
+    as a dict of name to (low, high, bins). Values outside that range are
+    counted in the first or last bin."""
+
+    def __init__(self, window=60.0, buckets=60, histograms=None):
+        if window <= 0 or buckets < 1:
+            raise ValueError("Window and bucket count must be positive")
+        for name, (low, high, bins) in (histograms or {}).items():
+            if low >= high or bins < 1:
+                raise ValueError("Invalid histogram for %s: needs low < high"\
+                    " and at least one bin" % name)
+
+        self.window = window
+        self.buckets = buckets
+        self.histograms = histograms or {}
+        self._width = window / buckets
+        # Per variable name, a list of buckets. Each bucket is a list of
+        # [bucket number, count, total, minimum, maximum, histogram].
+        self._channels = {}
+        self._latest = {}
+        self._alerts = []
+        self._now = None
+
+    def update(self, values, now=None):
+        """Adds one record. `values` is a dict keyed by variable name, as
+        returned by ECU.getLogValues, and `now` is the time of the record
+        in seconds on the time.monotonic clock, defaulting to the record's
+        sampled_ns if it's a LogRecord, or the current time. Missing values
+        are ignored.
+
+        A record older than the latest one is still counted, unless its
+        bucket has already been reused for newer values, in which case it's
+        dropped rather than overwriting them."""
+        if now is None:
+            sampled_ns = getattr(values, "sampled_ns", None)
+            now = time.monotonic() if sampled_ns is None \
+                else sampled_ns / 1e9
+        late = self._now is not None and now < self._now
+        if not late:
+            self._now = now
+        number = int(now // self._width)
+
+        for name, value in values.items():
+            if hasattr(value, "get"):
+                value = value.get()
+            # NaN doesn't equal itself.
+            if value is None or value != value:
+                continue
+            if not late:
+                self._latest[name] = value
+
+            channel = self._channels.get(name)
+            if channel is None:
+                channel = self._channels[name] = [None] * self.buckets
+
+            bucket = channel[number % self.buckets]
+            if bucket is not None and bucket[0] > number:
+                continue
+            if bucket is None or bucket[0] != number:
+                histogram = [0] * self.histograms[name][2] \
+                    if name in self.histograms else None
+                bucket = channel[number % self.buckets] = \
+                    [number, 0, 0, value, value, histogram]
+
+            bucket[1] += 1
+            bucket[2] += value
+            bucket[3] = min(bucket[3], value)
+            bucket[4] = max(bucket[4], value)
+            if bucket[5] is not None:
+                bucket[5][self._bin(name, value)] += 1
+
+        for alert in self._alerts:
+            alert.check(self)
+
+    def _bin(self, name, value):
+        low, high, bins = self.histograms[name]
+        index = int((value - low) * bins / (high - low))
+        return min(max(index, 0), bins - 1)
+
+    def _current(self, name, now):
+        """Returns the buckets for `name` that are still inside the window
+        ending at `now`."""
+        if now is None:
+            now = self._now if self._now is not None else time.monotonic()
+        number = int(now // self._width)
+        return [bucket for bucket in self._channels.get(name, [])
+            if bucket is not None and number - self.buckets < bucket[0] <= number]
+
+    def get(self, name, now=None):
+        """Returns a dict with the count, min, max and mean of `name` over
+        the window ending at `now`, which defaults to the time of the most
+        recent update. Returns None if there are no values in the window."""
+        buckets = self._current(name, now)
+        count = sum(bucket[1] for bucket in buckets)
+        if not count:
+            return None
+        return {
+                "count": count
+            ,   "min": min(bucket[3] for bucket in buckets)
+            ,   "max": max(bucket[4] for bucket in buckets)
+            ,   "mean": sum(bucket[2] for bucket in buckets) / count
+            }
+
+    def percentile(self, name, percent, now=None):
+        """Returns an estimate of the `percent` percentile (0 to 100) of
+        `name` over the window, interpolated within histogram bins. Returns
+        None if there are no values in the window."""
+        if name not in self.histograms:
+            raise ValueError("No histogram configured for %s" % name)
+        if not 0 <= percent <= 100:
+            raise ValueError("Percentile must be between 0 and 100")
+
+        low, high, bins = self.histograms[name]
+        merged = [0] * bins
+        for bucket in self._current(name, now):
+            for index, count in enumerate(bucket[5]):
+                merged[index] += count
+
+        total = sum(merged)
+        if not total:
+            return None
+
+        target = total * percent / 100
+        width = (high - low) / bins
+        seen = 0
+        for index, count in enumerate(merged):
+            if count and seen + count >= target:
+                return low + width * (index + (target - seen) / count)
+            seen += count
+        return high
+
+    def addAlert(self, name, callback, above=None, below=None,
+            statistic="value"):
+        """Calls `callback(name, value)` when `statistic` of `name` goes
+        above `above` or below `below`. `statistic` is "value" for the
+        latest value, or one of "min", "max" or "mean" over the window.
+        The callback is made once each time the threshold is crossed, not
+        for every record while it stays crossed."""
+        if statistic not in ("value", "min", "max", "mean"):
+            raise ValueError("Unknown statistic: %s" % statistic)
+        if above is None and below is None:
+            raise ValueError("An alert needs a threshold above or below")
+        self._alerts.append(_Alert(name, callback, above, below, statistic))
+
+
+class _Alert(object):
+    """A threshold on one statistic of a LogStatistics variable."""
+
+    def __init__(self, name, callback, above, below, statistic):
+        self.name = name
+        self.callback = callback
+        self.above = above
+        self.below = below
+        self.statistic = statistic
+        self.active = False
+
+    def check(self, stats):
+        if self.statistic == "value":
+            value = stats._latest.get(self.name)
+        else:
+            result = stats.get(self.name)
+            value = result[self.statistic] if result else None
+
+        active = value is not None and (
+            (self.above is not None and value > self.above)
+            or (self.below is not None and value < self.below))
+        was_active, self.active = self.active, active
+        if active and not was_active:
+            # A failing callback mustn't stop the record reaching other
+            # alerts and listeners.
+            try:
+                self.callback(self.name, value)
+            except Exception:
+                logger.exception("Alert callback for %s failed", self.name)
 
 
 class ECU:
     connected = False
+    baudrate = 10400
+
+    # Addresses are packed as four bytes and the most significant dropped.
+    _addr_struct = struct.Struct(">L")
 
     def __init__(self):
         self.port = pylibftdi.Device(mode='b', lazy_open=True)
         self._logged_variables = []
+        self._derived_variables = []
+        self._log_listeners = []
+        # The smallest time seen between the end of a log request and the
+        # start of its response, once transmission time is subtracted.
+        self._link_delay_ns = None
 
     def bitbang(self, value):
         """Wake up the ECU and tell it we're going to start talking to it.
@@ -184,8 +874,10 @@ class ECU:
             # Configure the serial port.
             self.port.open()
             self.port.ftdi_fn.ftdi_set_line_property(8, 1, 0)
-            self.port.baudrate = 10400
+            self.port.baudrate = self.baudrate = 10400
             self.port.flush()
+            # Link delays measured on an earlier connection don't apply.
+            self._link_delay_ns = None
 
             # Wait for ECU response to the bit banging wakeup call.
             waithex = [0x55, 0xef, 0x8f, 1]
@@ -220,8 +912,8 @@ class ECU:
         while (time.time() <= (timecheck + to)) & (isfound == False):
             try:
                 recvbyte = self.recvraw(1)
-                if recvbyte != "":
-                    recvdata = ord(recvbyte)
+                if recvbyte:
+                    recvdata = recvbyte[0]
                     capturebytes = capturebytes + [recvdata]
                     if recvdata == self.wf[idx]:
                         foundlist = foundlist + [recvdata]
@@ -237,8 +929,8 @@ class ECU:
         return [isfound, foundlist, capturebytes]
 
     def send(self, buf):
-        """Writes the list of bytes in `buf` to the serial port."""
-        self.port.write("".join([chr(b) for b in buf]))
+        """Writes `buf`, bytes or a list of ints, to the serial port."""
+        self.port.write(bytes(_asbytes(buf)))
 
     def recvraw(self, bytes):
         self.bytes = bytes
@@ -250,17 +942,25 @@ class ECU:
         isread = False
         while isread == False:
             recvbyte = self.port.read(self.bytes)
-            if recvbyte != "":
+            if recvbyte:
                 recvdata = recvbyte
                 isread = True
         return recvdata
 
+    def _recvexact(self, count):
+        """Returns a bytearray of exactly `count` bytes from the serial
+        port, reading as many at a time as are available."""
+        buf = bytearray()
+        while len(buf) < count:
+            buf += self.recv(count - len(buf))
+        return buf
+
     def sendCommand(self, buf):
         """Wraps raw KWP command in a length byte and a checksum byte and
         hands it to send(). Returns a boolean indicating whether
         validateCommand was satisfied with the response from the ECU."""
-        sendbuf = [len(buf)]
-        sendbuf.extend(buf)
+        sendbuf = bytearray([len(buf)])
+        sendbuf += _asbytes(buf)
         sendbuf.append(self.checksum(sendbuf))
 
         self.send(sendbuf)
@@ -269,38 +969,34 @@ class ECU:
     def _validateCommand(self, command):
         # Every KWP command is echoed back.  This clears out these bytes.
         self.command = command
-        cv = True
-        for i in range(len(self.command)):
-            recvdata = self.recv(1)
-            if ord(recvdata) != self.command[i]:
-                cv = cv & False
-        return cv
+        return self._recvexact(len(command)) == _asbytes(command)
 
     def checksum(self, buf):
-        """Returns an int that is the KWP2000 checksum of a list of ints."""
+        """Returns an int that is the KWP2000 checksum of bytes or a list
+        of ints."""
         return (sum(buf) & 0xff) % 0xff
 
     def getresponse(self):
-        # gets a properly formated KWP response from a command and returns the
-        # data.
+        """Returns a KWP response, including the length and checksum bytes,
+        as a list of ints."""
+        return list(self._getframe())
+
+    def _getframe(self):
+        """Reads a KWP response into a bytearray, including the length and
+        checksum bytes."""
         numbytes = 0
         # This is a hack because sometimes responses have leading 0x00's.  Why?
         # This removes them.
         while numbytes == 0:
-            numbytes = ord(self.recv(1))
-        gr = [numbytes]
-        logger.debug("Get bytes: " + hex(numbytes))
-        for i in range(numbytes):
-            recvdata = ord(self.recv(1))
-            logger.debug("Get byte" + str(i) + ": " + hex(recvdata))
-            gr = gr + [recvdata]
-        checkbyte = self.recv(1)
-        logger.debug(gr)
-        logger.debug("GR: " + hex(ord(checkbyte)) +
-                     "<-->" + hex(self.checksum(gr)))
+            numbytes = self._recvexact(1)[0]
+        frame = bytearray([numbytes])
+        frame += self._recvexact(numbytes + 1)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("GR: %s checksum 0x%02x<-->0x%02x",
+                binascii.hexlify(frame), frame[-1], self.checksum(frame[:-1]))
         # TODO Enforce the bloody checksum
         # TODO Don't return the checksum with the response
-        return (gr + [ord(checkbyte)])
+        return frame
 
     def readecuid(self, paramdef):
         # KWP2000 command to pull the ECU ID
@@ -345,7 +1041,9 @@ class ECU:
         sendlist = startdiagnosticsession + setbaud + bpsout
         self.sendCommand(sendlist)
         response = self.getresponse()
-        self.port.baudrate = self.bps
+        self.port.baudrate = self.baudrate = self.bps
+        # The link delay was measured at the old baud rate.
+        self._link_delay_ns = None
         time.sleep(1)
         return response
 
@@ -362,22 +1060,108 @@ class ECU:
     def readmembyaddr(self, readvals):
         # Function to read an area of ECU memory.
         self.readvals = readvals
-        rdmembyaddr = [0x23]
+        rdmembyaddr = [ReadMemoryByAddress]
         sendlist = rdmembyaddr + self.readvals
-        logger.debug("readmembyaddr() sendlist: " + sendlist)
+        logger.debug("readmembyaddr() sendlist: %s", sendlist)
         self.sendCommand(sendlist)
         response = self.getresponse()
-        logger.debug("readmembyaddr() response: " + response)
+        logger.debug("readmembyaddr() response: %s", response)
         return response
 
+    def readMemory(self, addr, size):
+        """Reads `size` bytes of memory starting at address `addr`, in as
+        few requests as possible. Returns a bytearray."""
+        data = bytearray()
+        while len(data) < size:
+            length = min(size - len(data), MaxReadSize)
+            self.sendCommand(bytearray([ReadMemoryByAddress])
+                + self._packAddr(addr + len(data)) + bytearray([length]))
+            response = self._getframe()
+            self._checkResponse(response, ReadMemoryByAddress)
+
+            # Strip the length, response code and checksum.
+            chunk = response[2:-1]
+            if len(chunk) != length:
+                raise RuntimeError("Asked for %d bytes at 0x%06x, got %d" % (
+                    length, addr + len(data), len(chunk)))
+            data += chunk
+        return data
+
     def writemembyaddr(self, addr, value):
         """Writes `value` to memory at address `addr`. `value` is expected
-        to be a list of ints, each representing one byte."""
-        cmd = [WriteMemoryByAddress] + self._splitAddr(addr) + [len(value)] + value
+        to be bytes or a list of ints, each representing one byte."""
+        cmd = bytearray([WriteMemoryByAddress])
+        cmd += self._packAddr(addr)
+        cmd.append(len(value))
+        cmd += _asbytes(value)
         self.sendCommand(cmd)
         response = self.getresponse()
         return response
 
+    def writeMemory(self, addr, image, current=None, verify=True, max_gap=8):
+        """Makes the memory starting at address `addr` match `image`, which
+        is bytes, a bytearray or a list of ints each representing one byte,
+        by writing only the bytes that differ from `current`. If the current contents aren't known they're
+        read from the ECU first.
+
+        Changed bytes separated by no more than `max_gap` unchanged bytes
+        are sent in the same request, because resending a few bytes is
+        cheaper than another round trip. Requests are as large as a frame
+        allows. If `verify` is true, only the written ranges are read back
+        and checked.
+
+        Returns a list of (address, length) tuples for each write made."""
+        image = _asbytes(image)
+        if current is None:
+            current = self.readMemory(addr, len(image))
+        current = _asbytes(current)
+        if len(current) != len(image):
+            raise ValueError("Current contents (%d bytes) and image (%d"\
+                " bytes) must be the same size" % (len(current), len(image)))
+
+        ranges = self._diffRanges(current, image, MaxWriteSize, max_gap)
+        for start, length in ranges:
+            response = self.writemembyaddr(addr + start,
+                image[start:start + length])
+            self._checkResponse(response, WriteMemoryByAddress)
+
+        if verify:
+            for start, length in ranges:
+                if self.readMemory(addr + start, length) \
+                        != image[start:start + length]:
+                    raise RuntimeError("Verification failed writing %d"\
+                        " bytes at 0x%06x" % (length, addr + start))
+
+        return [(addr + start, length) for start, length in ranges]
+
+    def _diffRanges(self, current, image, max_size, max_gap):
+        """Compares two equal length byte strings and returns a list of
+        (offset, length) tuples covering every difference. Differences
+        separated by at most `max_gap` equal bytes are merged, and no range
+        is longer than `max_size`."""
+        ranges = []
+        start = end = None
+        for offset, (old, new) in enumerate(zip(current, image)):
+            if old == new:
+                continue
+            if start is not None and offset - end <= max_gap \
+                    and offset - start < max_size:
+                end = offset + 1
+            else:
+                if start is not None:
+                    ranges.append((start, end - start))
+                start, end = offset, offset + 1
+        if start is not None:
+            ranges.append((start, end - start))
+        return ranges
+
+    def _checkResponse(self, response, command):
+        """Raises a RuntimeError unless `response` is a positive response
+        to `command`."""
+        if len(response) < 3 or response[1] != command + PositiveResponse:
+            raise RuntimeError("ECU rejected command 0x%02x: %s" % (
+                command, response))
+
     def testerpresent(self):
         # KWP2000 TesterPresent command
         tp = [0x3E]
@@ -391,12 +1175,12 @@ class ECU:
 
 
         # 0x03 probably means to expect three byte addresses. Untested.
-        cmd = [SetupLogging, 0x03]
+        cmd = bytearray([SetupLogging, 0x03])
 
         for var in variables:
-            # Convert the integer address value to a list of three bytes and
-            # add it to the pending command.
-            addr = self._splitAddr(var.addr)
+            # Convert the integer address value to three bytes and add it to
+            # the pending command.
+            addr = bytearray(self._packAddr(var.addr))
 
             # Telling the ECU we want to read two bytes is done by adding
             # 0x40 to the most significant byte.
@@ -413,10 +1197,27 @@ class ECU:
         self.sendCommand(cmd)
         return self.getresponse()
 
+    def addDerivedVariables(self, *variables):
+        """Adds DerivedVariables to be computed from the logged variables
+        and returned alongside them by getLogValues. The expressions are
+        compiled when each DerivedVariable is created, not per record."""
+        self._derived_variables.extend(variables)
+
+    def addLogListeners(self, *listeners):
+        """Adds callables to be called with each dict of values returned
+        by getLogValues, e.g. LogStatistics.update or
+        SamplePublisher.publish. Exceptions raised by a listener are logged
+        and don't stop the other listeners or getLogValues."""
+        self._log_listeners.extend(listeners)
+
     def getLogValues(self):
         """Fetches a value for each configured variable from the ECU and
-        returns a dict of Variables, keyed by the variable name."""
-        raw_result = self.getlogrecord()
+        returns a LogRecord, a dict of Variables keyed by the variable name
+        and stamped with the request, response and estimated sample times.
+        Any DerivedVariables added with addDerivedVariables are included."""
+        sent_ns = _monotonic_ns()
+        raw_result = memoryview(_asbytes(self._getlogframe()))
+        received_ns = _monotonic_ns()
 
         # Strip header and checksum.
         length = raw_result[0]
@@ -426,7 +1227,8 @@ class ECU:
         checksum = raw_result[-1]
         result = raw_result[2:-1]
 
-        response = {}
+        response = LogRecord(sent_ns, received_ns,
+            self._estimateSampleTime(sent_ns, received_ns, len(raw_result)))
         index = 0
         for var in self._logged_variables:
             # Slice out the bytes relevant to this variable.
@@ -439,16 +1241,62 @@ class ECU:
             response[copied_var.name] = copied_var
 
             index += var.size
+
+        # Derived variables are evaluated in the order they were added, so
+        # each one can refer to any raw variable or earlier derived one.
+        for var in self._derived_variables:
+            copied_var = copy.copy(var)
+            copied_var.value = var.evaluate(response)
+            response[copied_var.name] = copied_var
+
+        # A failing listener is logged rather than losing the record for
+        # the caller and the remaining listeners.
+        for listener in self._log_listeners:
+            try:
+                listener(response)
+            except Exception:
+                logger.exception("Log listener %r failed", listener)
+
         return response
     
+    def _estimateSampleTime(self, sent_ns, received_ns, response_length):
+        """Estimates when the ECU read the values in a log response, from
+        the time the request was sent and the response fully received.
+
+        The ECU reads memory just before it starts replying, so the sample
+        time is the receive time less the time to transmit the response (10
+        bits per byte at the current baud rate) and the link delay back to
+        us. The link delay is estimated as half the smallest round trip
+        overhead seen so far, which is the least affected by scheduling
+        and the ECU taking its time to answer."""
+        bit_ns = 1e9 / self.baudrate
+        # Length, command and checksum bytes.
+        request_ns = 3 * 10 * bit_ns
+        response_ns = response_length * 10 * bit_ns
+
+        delay_ns = max(0, received_ns - sent_ns - request_ns - response_ns)
+        if self._link_delay_ns is None or delay_ns < self._link_delay_ns:
+            self._link_delay_ns = delay_ns
+
+        sampled_ns = received_ns - response_ns - self._link_delay_ns / 2
+        return max(sent_ns, int(sampled_ns))
+
     def getlogrecord(self):
-        """Returns a list of bytes representing the values of the memory
-        addresses previously added to the logging list."""
-        self.sendCommand([0xb7])
-        return self.getresponse()
+        """Returns the response frame with the values of the memory
+        addresses previously added to the logging list, as a list of ints."""
+        return list(self._getlogframe())
+
+    def _getlogframe(self):
+        """Like getlogrecord, but returns the frame as a bytearray."""
+        self.sendCommand([SetupLogging])
+        return self._getframe()
     
     def _splitAddr(self, addr):
         """Takes an integer memory address in `addr`, assumes a maximum
         three byte length, and returns a list of three ints corresponding
         to these three bytes, most significant first."""
-        return [ord(b) for b in struct.pack(">L", addr)[1:]]
+        return list(self._packAddr(addr))
+
+    def _packAddr(self, addr):
+        """Like _splitAddr, but returns the three bytes as bytes."""
+        return self._addr_struct.pack(addr)[1:]
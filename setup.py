@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 from setuptools import setup, find_packages
-from pip.req import parse_requirements
 
 setup(
       name='me7'
@@ -11,5 +10,7 @@ setup(
    ,  author_email='derpston@example.com'
    ,  url='https://example.com'
    ,  install_requires=['pylibftdi']
+   ,  extras_require={'numpy': ['numpy']}
+   ,  python_requires='>=3'
    ,  test_suite='tests'
 )
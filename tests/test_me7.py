@@ -1,7 +1,17 @@
-from unittest import TestCase
-import mock
+from unittest import TestCase, mock, skipUnless
 import me7
-import StringIO
+import io
+import copy
+import pickle
+import tempfile
+import shutil
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestECUExists(TestCase):
@@ -42,10 +52,10 @@ class TestCommandValidate(TestCase):
             self.ecu = me7.ECU()
 
     def test_commandValidate(self):
-        with mock.patch("me7.ECU.recv", return_value = "\x00"):
+        with mock.patch("me7.ECU.recv", return_value = b"\x00"):
             self.assertTrue(self.ecu._validateCommand([0x00]))
     
-        with mock.patch("me7.ECU.recv", return_value = "\x00"):
+        with mock.patch("me7.ECU.recv", return_value = b"\x00"):
             self.assertFalse(self.ecu._validateCommand([0x01]))
 
 class TestSendCommand(TestCase):
@@ -60,21 +70,21 @@ class TestSendCommand(TestCase):
     def test_sendCommand(self, checksum, validate):
         with mock.patch("me7.ECU.send") as send:
             self.assertTrue(self.ecu.sendCommand([0x00]))
-            send.assert_called_once_with([1, 0, 0])
+            send.assert_called_once_with(bytearray([1, 0, 0]))
         
         with mock.patch("me7.ECU.send") as send:
             self.assertTrue(self.ecu.sendCommand([0x01]))
-            send.assert_called_once_with([1, 1, 0])
+            send.assert_called_once_with(bytearray([1, 1, 0]))
  
         checksum.return_value = 1
         with mock.patch("me7.ECU.send") as send:
             self.assertTrue(self.ecu.sendCommand([0x01]))
-            send.assert_called_once_with([1, 1, 1])
+            send.assert_called_once_with(bytearray([1, 1, 1]))
 
         checksum.return_value = 0
         with mock.patch("me7.ECU.send") as send:
             self.assertTrue(self.ecu.sendCommand([0x01, 0x01, 0x01]))
-            send.assert_called_once_with([3, 1, 1, 1, 0])
+            send.assert_called_once_with(bytearray([3, 1, 1, 1, 0]))
 
 
 class TestSend(TestCase):
@@ -86,13 +96,17 @@ class TestSend(TestCase):
 
     def test_send(self):
         # The port should be a file-like object.
-        self.ecu.port = StringIO.StringIO()
+        self.ecu.port = io.BytesIO()
         self.ecu.send([0x00])
-        self.assertEqual("\x00", self.ecu.port.getvalue())
+        self.assertEqual(b"\x00", self.ecu.port.getvalue())
         
-        self.ecu.port = StringIO.StringIO()
+        self.ecu.port = io.BytesIO()
         self.ecu.send([0x00, 0x01, 0xff])
-        self.assertEqual("\x00\x01\xff", self.ecu.port.getvalue())
+        self.assertEqual(b"\x00\x01\xff", self.ecu.port.getvalue())
+
+        self.ecu.port = io.BytesIO()
+        self.ecu.send(b"\x00\x01\xff")
+        self.assertEqual(b"\x00\x01\xff", self.ecu.port.getvalue())
 
 
 class TestBitBang(TestCase):
@@ -165,6 +179,15 @@ class TestOpen(TestCase):
         self.ecu.port.ftdi_fn.ftdi_set_line_property.assert_called_once_with(8, 1, 0)
         self.assertEqual(self.ecu.port.baudrate, 10400)
         self.ecu.port.flush.assert_called_once_with()
+
+    @mock.patch("me7.ECU.bitbang")
+    @mock.patch("me7.ECU.waitfor", side_effect=[[True], [True]])
+    @mock.patch("time.sleep")
+    def test_reconnect_link_delay(self, sleep, waitfor, bitbang):
+        # A link delay measured on an earlier connection is forgotten.
+        self.ecu._link_delay_ns = 1000
+        self.ecu.open("SLOW-0x11")
+        self.assertEqual(self.ecu._link_delay_ns, None)
     
 
 class TestSetupLogRecord(TestCase):
@@ -179,14 +202,14 @@ class TestSetupLogRecord(TestCase):
     def test_preparelogvariables(self, getresponse, sendCommand):
         var1 = me7.Variable("foo", 0x00)
         self.ecu.prepareLogVariables(var1)
-        sendCommand.assert_called_with([0xb7, 0x03, 0x00, 0x00, 0x00])
+        sendCommand.assert_called_with(bytearray([0xb7, 0x03, 0x00, 0x00, 0x00]))
 
         var2 = me7.Variable("foo", 0x010203)
         self.ecu.prepareLogVariables(var2)
-        sendCommand.assert_called_with([0xb7, 0x03, 0x01, 0x02, 0x03])
+        sendCommand.assert_called_with(bytearray([0xb7, 0x03, 0x01, 0x02, 0x03]))
         
         self.ecu.prepareLogVariables(var1, var2)
-        sendCommand.assert_called_with([0xb7, 0x03, 0x00, 0x00, 0x00, 0x01, 0x02, 0x03])
+        sendCommand.assert_called_with(bytearray([0xb7, 0x03, 0x00, 0x00, 0x00, 0x01, 0x02, 0x03]))
 
 class TestGetLogRecord(TestCase):
     """Requests values for all log records used previously in setuplogrecord"""
@@ -196,9 +219,11 @@ class TestGetLogRecord(TestCase):
         self.ecu = me7.ECU()
 
     @mock.patch("me7.ECU.sendCommand")
-    @mock.patch("me7.ECU.getresponse")
-    def test_connect(self, getresponse, sendCommand):
-        self.ecu.getlogrecord()
+    @mock.patch("me7.ECU._getframe")
+    def test_connect(self, getframe, sendCommand):
+        getframe.return_value = bytearray([0x02, 0xf7, 0x05, 0x00])
+        # The list of ints form is kept for existing callers.
+        self.assertEqual(self.ecu.getlogrecord(), [0x02, 0xf7, 0x05, 0x00])
         sendCommand.assert_called_with([0xb7])
 
 
@@ -214,7 +239,7 @@ class TestWriteMemByAddr(TestCase):
     @mock.patch("me7.logger")
     def test_writemembyaddr(self, logger, getresponse, sendCommand):
         self.ecu.writemembyaddr(0x00e228, [0x00, 0x3a, 0xe1, 0x00])
-        sendCommand.assert_called_with([0x3d, 0x00, 0xe2, 0x28, 0x04, 0x00, 0x3a, 0xe1, 0x00])
+        sendCommand.assert_called_with(bytearray([0x3d, 0x00, 0xe2, 0x28, 0x04, 0x00, 0x3a, 0xe1, 0x00]))
 
 class TestSplitBytes(TestCase):
     @mock.patch("pylibftdi.Device")
@@ -226,6 +251,10 @@ class TestSplitBytes(TestCase):
         self.assertEqual(self.ecu._splitAddr(0x000056), [0x00, 0x00, 0x56])
         self.assertEqual(self.ecu._splitAddr(0x56), [0x00, 0x00, 0x56])
 
+    def test_packaddr(self):
+        self.assertEqual(self.ecu._packAddr(0x123456), b"\x12\x34\x56")
+        self.assertEqual(self.ecu._packAddr(0x56), b"\x00\x00\x56")
+
 class TestVariable(TestCase):
     def test_factor_offset(self):
         var = me7.Variable("foo", 0x00)
@@ -306,15 +335,557 @@ class TestVariable(TestCase):
             var.set([0x00, 0x00, 0x00, 0x00])
             var.set([])
 
+    def test_pickle(self):
+        var = me7.Variable("foo", 0x00, size=2, signed=True)
+        var.set(memoryview(bytearray([0xff, 0xfe])))
+        copied_var = pickle.loads(pickle.dumps(var))
+        self.assertEqual(copied_var.get(), -2)
+        self.assertEqual(copy.deepcopy(var).get(), -2)
+
 class TestGetLogValues(TestCase):
     @mock.patch("pylibftdi.Device")
     def setUp(self, device):
         self.ecu = me7.ECU()
 
-    @mock.patch("me7.ECU.getlogrecord")
-    def test_getlogvalues(self, getlogrecord):
+    @mock.patch("me7.ECU._getlogframe")
+    def test_getlogvalues(self, getlogframe):
         self.ecu._logged_variables.append(me7.Variable("foo", 0x00))
-        getlogrecord.return_value = [0x00, 0x00, 0x01, 0x00]
+        getlogframe.return_value = [0x00, 0x00, 0x01, 0x00]
         variables = self.ecu.getLogValues()
         self.assertEqual(variables['foo'].get(), 1)
  
+
+class TestDerivedVariable(TestCase):
+    def test_inputs(self):
+        var = me7.DerivedVariable("load", "airflow / rpm * 100")
+        self.assertEqual(var.inputs, ("airflow", "rpm"))
+
+        var = me7.DerivedVariable("lambda_error", "abs(lambda_target - lambda_actual)")
+        self.assertEqual(var.inputs, ("lambda_target", "lambda_actual"))
+
+    def test_bad_expression(self):
+        with self.assertRaises(ValueError):
+            me7.DerivedVariable("foo", "bar +")
+
+        with self.assertRaises(ValueError):
+            me7.DerivedVariable("foo", "__import__('os')")
+
+        with self.assertRaises(ValueError):
+            me7.DerivedVariable("foo", "bar.baz")
+
+        with self.assertRaises(ValueError):
+            me7.DerivedVariable("foo", "[bar for bar in baz]")
+
+        with self.assertRaises(ValueError):
+            me7.DerivedVariable("foo", "bar * 'baz'")
+
+        with self.assertRaises(ValueError):
+            me7.DerivedVariable("foo", "bar + 1j")
+
+    def test_evaluate(self):
+        var = me7.DerivedVariable("boost", "manifold - ambient")
+        self.assertEqual(var.evaluate({"manifold": 1500, "ambient": 1000}), 500)
+
+        raw = me7.Variable("manifold", 0x00, factor=10)
+        raw.set([150])
+        self.assertEqual(var.evaluate({"manifold": raw, "ambient": 1000}), 500)
+
+        # Missing inputs give no value rather than an exception.
+        self.assertEqual(var.evaluate({"manifold": 1500}), None)
+        self.assertEqual(var.evaluate({"manifold": me7.Variable("manifold", 0x00),
+            "ambient": 1000}), None)
+
+    def test_evaluate_columns(self):
+        var = me7.DerivedVariable("boost", "manifold - ambient")
+        self.assertEqual(var.evaluateColumns(
+            {"manifold": [1500, 2000], "ambient": [1000, 1000]}), [500, 1000])
+
+        self.assertEqual(var.evaluateBatch([
+            {"manifold": 1500, "ambient": 1000},
+            {"manifold": 2000, "ambient": 1000}]), [500, 1000])
+
+        # Missing values and arithmetic errors give None, as evaluate does.
+        var = me7.DerivedVariable("load", "airflow / rpm")
+        self.assertEqual(var.evaluateColumns(
+            {"airflow": [10, None, 10], "rpm": [2, 2, 0]}), [5, None, None])
+
+        # Constant expressions give one value per record.
+        var = me7.DerivedVariable("one", "1")
+        self.assertEqual(var.evaluateColumns({"foo": [1, 2, 3]}), [1, 1, 1])
+        self.assertEqual(var.evaluateColumns({}), [])
+
+        # A missing input column gives None for every record.
+        var = me7.DerivedVariable("boost", "manifold - ambient")
+        self.assertEqual(var.evaluateColumns({"manifold": [1500, 2000]}),
+            [None, None])
+
+    @skipUnless(numpy, "numpy is not installed")
+    def test_evaluate_arrays(self):
+        var = me7.DerivedVariable("load", "abs(airflow / rpm) * 2")
+        result = var.evaluateColumns({"airflow": numpy.array([10.0, -10.0]),
+            "rpm": numpy.array([2.0, 5.0])})
+        self.assertIsInstance(result, numpy.ndarray)
+        self.assertEqual(result.tolist(), [10.0, 4.0])
+
+        # Non-vectorisable expressions fall back to one call per record.
+        var = me7.DerivedVariable("peak", "max(a, b)")
+        self.assertEqual(var.evaluateColumns({"a": numpy.array([1, 5]),
+            "b": numpy.array([3, 2])}), [3, 5])
+
+    def test_vectorisable(self):
+        self.assertTrue(me7.DerivedVariable("foo", "abs(a - b) * 2 > c").vectorisable)
+        self.assertFalse(me7.DerivedVariable("foo", "a if b else c").vectorisable)
+        self.assertFalse(me7.DerivedVariable("foo", "a and b").vectorisable)
+        self.assertFalse(me7.DerivedVariable("foo", "not a").vectorisable)
+        self.assertFalse(me7.DerivedVariable("foo", "a < b < c").vectorisable)
+        self.assertFalse(me7.DerivedVariable("foo", "max(a, b)").vectorisable)
+
+    def test_evaluate_error(self):
+        var = me7.DerivedVariable("load", "airflow / rpm")
+        self.assertEqual(var.evaluate({"airflow": 10, "rpm": 0}), None)
+
+        # Fractional powers of negative numbers are complex in Python 3.
+        var = me7.DerivedVariable("root", "foo ** 0.5")
+        self.assertEqual(var.evaluate({"foo": 4}), 2)
+        self.assertEqual(var.evaluate({"foo": -4}), None)
+        var = me7.DerivedVariable("root", "foo ** 0.5 > 1")
+        self.assertEqual(var.evaluate({"foo": -4}), None)
+
+    def test_pickle(self):
+        var = me7.DerivedVariable("boost", "manifold - ambient", unit="kPa")
+        var.value = 500
+        copied_var = pickle.loads(pickle.dumps(var))
+        self.assertEqual(copied_var.get(), 500)
+        self.assertEqual(copied_var.unit, "kPa")
+        self.assertEqual(copied_var.evaluate({"manifold": 3, "ambient": 1}), 2)
+
+    def test_getlogvalues(self):
+        with mock.patch("pylibftdi.Device"):
+            ecu = me7.ECU()
+        ecu._logged_variables = [me7.Variable("foo", 0x00), me7.Variable("bar", 0x01)]
+        ecu.addDerivedVariables(
+            me7.DerivedVariable("sum", "foo + bar"),
+            me7.DerivedVariable("double_sum", "sum * 2"))
+
+        with mock.patch("me7.ECU._getlogframe", return_value=[0x00, 0x00, 0x01, 0x02, 0x00]):
+            variables = ecu.getLogValues()
+        self.assertEqual(variables['sum'].get(), 3)
+        self.assertEqual(variables['double_sum'].get(), 6)
+
+    def test_getlogvalues_no_compile(self):
+        with mock.patch("pylibftdi.Device"):
+            ecu = me7.ECU()
+        ecu._logged_variables = [me7.Variable("foo", 0x00)]
+        ecu.addDerivedVariables(me7.DerivedVariable("double", "foo * 2"))
+
+        # The expression is compiled once, not for every record.
+        with mock.patch("me7.ECU._getlogframe", return_value=[0x00, 0x00, 0x01, 0x00]), \
+                mock.patch("me7.DerivedVariable._compile") as compile_:
+            for i in range(3):
+                variables = ecu.getLogValues()
+        self.assertEqual(variables['double'].get(), 2)
+        compile_.assert_not_called()
+
+
+class TestSharedSamples(TestCase):
+    """Publishes logged values to other processes through shared memory."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "samples")
+        self.variables = [me7.Variable("foo", 0x00, unit="rpm"),
+            me7.Variable("bar", 0x01, unit="kPa")]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_schema(self):
+        publisher = me7.SamplePublisher(self.path, self.variables, capacity=4)
+        reader = me7.SampleReader(self.path)
+        self.assertEqual(reader.names, ["foo", "bar"])
+        self.assertEqual(reader.units, {"foo": "rpm", "bar": "kPa"})
+        self.assertEqual(reader.capacity, 4)
+        self.assertEqual(reader.latest(), None)
+        self.assertEqual(reader.history(), [])
+        reader.close()
+        publisher.close()
+
+    def test_latest(self):
+        publisher = me7.SamplePublisher(self.path, self.variables, capacity=4)
+        reader = me7.SampleReader(self.path)
+        publisher.publish({"foo": 1, "bar": 2})
+        timestamp, values = reader.latest()
+        self.assertEqual(values, {"foo": 1, "bar": 2})
+
+        publisher.publish({"foo": 3})
+        timestamp, values = reader.latest()
+        self.assertEqual(values["foo"], 3)
+        self.assertNotEqual(values["bar"], values["bar"]) # NaN
+        reader.close()
+        publisher.close()
+
+    def test_history(self):
+        publisher = me7.SamplePublisher(self.path, self.variables, capacity=4)
+        reader = me7.SampleReader(self.path)
+        for i in range(6):
+            publisher.publish({"foo": i, "bar": i * 2})
+
+        self.assertEqual(reader.count(), 6)
+        self.assertEqual([values["foo"] for _, values in reader.history()],
+            [2, 3, 4, 5])
+        self.assertEqual([values["bar"] for _, values in reader.history(2)],
+            [8, 10])
+        reader.close()
+        publisher.close()
+
+    def test_bad_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\x00" * 64)
+        with self.assertRaises(ValueError):
+            me7.SampleReader(self.path)
+
+        with open(self.path, "wb") as f:
+            pass
+        with self.assertRaises(ValueError):
+            me7.SampleReader(self.path)
+
+    def test_replaced(self):
+        publisher = me7.SamplePublisher(self.path, self.variables, capacity=4)
+        publisher.publish({"foo": 1, "bar": 2})
+        reader = me7.SampleReader(self.path)
+        self.assertEqual(reader.latest()[1], {"foo": 1, "bar": 2})
+        publisher.close()
+
+        # A restarted publisher with a different layout doesn't disturb
+        # the old mapping, and the reader switches to the new file.
+        publisher = me7.SamplePublisher(self.path, self.variables[:1], capacity=2)
+        publisher.publish({"foo": 3})
+        self.assertEqual(reader.latest()[1], {"foo": 3})
+        self.assertEqual(reader.names, ["foo"])
+        self.assertEqual(reader.capacity, 2)
+        self.assertEqual(os.listdir(self.dir), ["samples"])
+        reader.close()
+        publisher.close()
+
+    def test_permissions(self):
+        # Readers may run as other users, so the umask applies as it would
+        # for open() rather than the file being private.
+        umask = os.umask(0o022)
+        try:
+            publisher = me7.SamplePublisher(self.path, self.variables)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        publisher.close()
+
+    def test_bad_schema(self):
+        with self.assertRaises(ValueError):
+            me7.SamplePublisher(self.path, [me7.Variable("foo\tbar", 0x00)])
+        with self.assertRaises(ValueError):
+            me7.SamplePublisher(self.path, [me7.Variable("foo", 0x00, unit="k\nPa")])
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_failed_publisher(self):
+        # Nothing is left behind if the buffer can't be set up.
+        with mock.patch("me7.SamplePublisher._header") as header:
+            header.pack_into.side_effect = struct.error
+            with self.assertRaises(struct.error):
+                me7.SamplePublisher(self.path, self.variables)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_stalled_publisher(self):
+        publisher = me7.SamplePublisher(self.path, self.variables, capacity=4)
+        reader = me7.SampleReader(self.path, timeout=0.01)
+
+        # A publisher that died mid-write leaves the sequence number odd.
+        publisher._counter.pack_into(publisher._map, publisher._seq_offset, 1)
+        with self.assertRaises(RuntimeError):
+            reader.latest()
+        reader.close()
+        publisher.close()
+
+class TestWriteMemory(TestCase):
+    """Writes only the changed parts of a block of memory."""
+
+    @mock.patch("pylibftdi.Device")
+    def setUp(self, device):
+        self.ecu = me7.ECU()
+
+    def test_diffranges(self):
+        self.assertEqual(self.ecu._diffRanges([0] * 8, [0] * 8, 250, 0), [])
+        self.assertEqual(self.ecu._diffRanges([0, 0, 0], [0, 1, 0], 250, 0),
+            [(1, 1)])
+        self.assertEqual(self.ecu._diffRanges([0] * 8, [1, 0, 0, 1, 0, 0, 0, 1], 250, 0),
+            [(0, 1), (3, 1), (7, 1)])
+
+        # Small gaps are merged, larger ones aren't.
+        self.assertEqual(self.ecu._diffRanges([0] * 8, [1, 0, 0, 1, 0, 0, 0, 1], 250, 2),
+            [(0, 4), (7, 1)])
+        self.assertEqual(self.ecu._diffRanges([0] * 8, [1, 0, 0, 1, 0, 0, 0, 1], 250, 3),
+            [(0, 8)])
+
+        # Ranges are split at the maximum size.
+        self.assertEqual(self.ecu._diffRanges([0] * 8, [1] * 8, 3, 0),
+            [(0, 3), (3, 3), (6, 2)])
+
+    @mock.patch("me7.ECU.readMemory")
+    @mock.patch("me7.ECU.writemembyaddr", return_value=[0x01, 0x7d, 0x7e])
+    def test_writememory(self, writemembyaddr, readMemory):
+        current = [0x00] * 16
+        image = list(current)
+        image[2] = 0x11
+        image[12:14] = [0x22, 0x33]
+        readMemory.side_effect = lambda addr, size: \
+            bytearray(image[addr - 0x380000:][:size])
+
+        ranges = self.ecu.writeMemory(0x380000, image, current)
+        self.assertEqual(ranges, [(0x380002, 1), (0x38000c, 2)])
+        self.assertEqual(writemembyaddr.call_args_list, [
+            mock.call(0x380002, bytearray([0x11])),
+            mock.call(0x38000c, bytearray([0x22, 0x33]))])
+        self.assertEqual(readMemory.call_args_list, [
+            mock.call(0x380002, 1), mock.call(0x38000c, 2)])
+
+    @mock.patch("me7.ECU.readMemory", return_value=bytearray([0x00]))
+    @mock.patch("me7.ECU.writemembyaddr", return_value=[0x01, 0x7d, 0x7e])
+    def test_writememory_unknown_current(self, writemembyaddr, readMemory):
+        self.ecu.writeMemory(0x380000, [0x00])
+        readMemory.assert_called_once_with(0x380000, 1)
+        self.assertFalse(writemembyaddr.called)
+
+    @mock.patch("me7.ECU.readMemory", return_value=bytearray([0x00]))
+    @mock.patch("me7.ECU.writemembyaddr", return_value=[0x01, 0x7d, 0x7e])
+    def test_writememory_verify(self, writemembyaddr, readMemory):
+        with self.assertRaises(RuntimeError):
+            self.ecu.writeMemory(0x380000, [0x01], [0x00])
+
+    @mock.patch("me7.ECU.writemembyaddr", return_value=[0x03, 0x7f, 0x3d, 0x31, 0xf0])
+    def test_writememory_rejected(self, writemembyaddr):
+        with self.assertRaises(RuntimeError):
+            self.ecu.writeMemory(0x380000, [0x01], [0x00])
+
+    @mock.patch("me7.ECU.sendCommand")
+    @mock.patch("me7.ECU._getframe")
+    def test_readmemory(self, getframe, sendCommand):
+        getframe.side_effect = lambda: bytearray([sendCommand.call_args[0][0][4] + 1, 0x63]
+            + [0xaa] * sendCommand.call_args[0][0][4] + [0x00])
+        self.assertEqual(self.ecu.readMemory(0x380000, 300), bytearray([0xaa] * 300))
+        self.assertEqual(sendCommand.call_args_list, [
+            mock.call(bytearray([0x23, 0x38, 0x00, 0x00, me7.MaxReadSize])),
+            mock.call(bytearray([0x23, 0x38, 0x00, 0xfe, 300 - me7.MaxReadSize]))])
+
+
+class TestGetResponse(TestCase):
+    """Reads a KWP response frame from the serial port."""
+
+    @mock.patch("pylibftdi.Device")
+    def setUp(self, device):
+        self.ecu = me7.ECU()
+
+    def test_getresponse(self):
+        self.ecu.port.read.side_effect = [b"\x00", b"\x02", b"\x7e", b"\x01\x81"]
+        self.assertEqual(self.ecu.getresponse(), [0x02, 0x7e, 0x01, 0x81])
+
+    def test_getframe(self):
+        self.ecu.port.read.side_effect = [b"\x02", b"\x7e\x01\x81"]
+        self.assertEqual(self.ecu._getframe(), bytearray([0x02, 0x7e, 0x01, 0x81]))
+
+    @mock.patch("me7.ECU.sendCommand")
+    def test_getlogvalues_bytes(self, sendCommand):
+        self.ecu._logged_variables = [me7.Variable("foo", 0x00),
+            me7.Variable("bar", 0x01, size=2, signed=True)]
+        self.ecu.port.read.side_effect = [b"\x04", b"\xf7\x05\xff\xfe\x00"]
+        variables = self.ecu.getLogValues()
+        self.assertEqual(variables["foo"].get(), 5)
+        self.assertEqual(variables["bar"].get(), -2)
+
+class TestLogStatistics(TestCase):
+    """Rolling statistics over a time window of logged values."""
+
+    def test_get(self):
+        stats = me7.LogStatistics(window=10, buckets=10)
+        self.assertEqual(stats.get("foo"), None)
+
+        for i in range(5):
+            stats.update({"foo": i, "bar": None}, now=100 + i)
+        self.assertEqual(stats.get("foo"),
+            {"count": 5, "min": 0, "max": 4, "mean": 2})
+        self.assertEqual(stats.get("bar"), None)
+
+    def test_window(self):
+        stats = me7.LogStatistics(window=10, buckets=10)
+        for i in range(30):
+            stats.update({"foo": i}, now=100 + i)
+
+        # Only the last ten seconds are kept.
+        self.assertEqual(stats.get("foo"),
+            {"count": 10, "min": 20, "max": 29, "mean": 24.5})
+        self.assertEqual(stats.get("foo", now=135), {"count": 4, "min": 26,
+            "max": 29, "mean": 27.5})
+        self.assertEqual(stats.get("foo", now=200), None)
+
+        # Memory use is bounded by the number of buckets.
+        self.assertEqual(len(stats._channels["foo"]), 10)
+
+    def test_out_of_order(self):
+        stats = me7.LogStatistics(window=10, buckets=10)
+        stats.update({"foo": 1}, now=105)
+        # A late record whose bucket has been reused for newer values is
+        # dropped rather than overwriting them.
+        stats.update({"foo": 2}, now=95)
+        self.assertEqual(stats.get("foo", now=105),
+            {"count": 1, "min": 1, "max": 1, "mean": 1})
+
+        # One that's late but still in its bucket is counted, without
+        # becoming the latest value.
+        stats.update({"foo": 3}, now=104)
+        self.assertEqual(stats.get("foo")["count"], 2)
+        self.assertEqual(stats._latest["foo"], 1)
+
+    def test_variables(self):
+        stats = me7.LogStatistics()
+        var = me7.Variable("foo", 0x00, factor=2)
+        var.set([3])
+        stats.update({"foo": var, "bar": me7.Variable("bar", 0x01)}, now=1)
+        self.assertEqual(stats.get("foo")["mean"], 6)
+        self.assertEqual(stats.get("bar"), None)
+
+    def test_percentile(self):
+        stats = me7.LogStatistics(window=10, histograms={"foo": (0, 100, 100)})
+        for i in range(100):
+            stats.update({"foo": i + 0.5}, now=i * 0.01)
+        self.assertAlmostEqual(stats.percentile("foo", 50), 50)
+        self.assertAlmostEqual(stats.percentile("foo", 90), 90)
+        self.assertAlmostEqual(stats.percentile("foo", 100), 100)
+
+        with self.assertRaises(ValueError):
+            stats.percentile("bar", 50)
+        with self.assertRaises(ValueError):
+            stats.percentile("foo", 101)
+
+    def test_bad_histogram(self):
+        with self.assertRaises(ValueError):
+            me7.LogStatistics(histograms={"foo": (5, 5, 10)})
+        with self.assertRaises(ValueError):
+            me7.LogStatistics(histograms={"foo": (0, 100, 0)})
+
+    def test_alert(self):
+        stats = me7.LogStatistics(window=10, buckets=10)
+        callback = mock.Mock()
+        stats.addAlert("foo", callback, above=5)
+        stats.addAlert("foo", callback, below=1, statistic="mean")
+
+        for now, value in enumerate([2, 6, 7, 3, 8]):
+            stats.update({"foo": value}, now=now)
+        # Each crossing is reported once.
+        self.assertEqual(callback.call_args_list,
+            [mock.call("foo", 6), mock.call("foo", 8)])
+
+        with self.assertRaises(ValueError):
+            stats.addAlert("foo", callback, above=1, statistic="median")
+        with self.assertRaises(ValueError):
+            stats.addAlert("foo", callback)
+
+    @mock.patch("me7.logger")
+    def test_alert_error(self, logger):
+        stats = me7.LogStatistics(window=10, buckets=10)
+        callback = mock.Mock()
+        stats.addAlert("foo", mock.Mock(side_effect=Exception), above=5)
+        stats.addAlert("foo", callback, above=5)
+
+        stats.update({"foo": 6}, now=1)
+        callback.assert_called_once_with("foo", 6)
+        self.assertEqual(stats.get("foo")["count"], 1)
+        self.assertTrue(logger.exception.called)
+
+    def test_listener(self):
+        with mock.patch("pylibftdi.Device"):
+            ecu = me7.ECU()
+        ecu._logged_variables = [me7.Variable("foo", 0x00)]
+        listener = mock.Mock()
+        ecu.addLogListeners(listener)
+
+        with mock.patch("me7.ECU._getlogframe", return_value=[0x00, 0x00, 0x01, 0x00]):
+            variables = ecu.getLogValues()
+        listener.assert_called_once_with(variables)
+
+    @mock.patch("me7.logger")
+    def test_listener_error(self, logger):
+        with mock.patch("pylibftdi.Device"):
+            ecu = me7.ECU()
+        ecu._logged_variables = [me7.Variable("foo", 0x00)]
+        listener = mock.Mock()
+        ecu.addLogListeners(mock.Mock(side_effect=Exception), listener)
+
+        # The record still reaches the caller and later listeners.
+        with mock.patch("me7.ECU._getlogframe", return_value=[0x00, 0x00, 0x01, 0x00]):
+            variables = ecu.getLogValues()
+        self.assertEqual(variables["foo"].get(), 1)
+        listener.assert_called_once_with(variables)
+        self.assertTrue(logger.exception.called)
+
+class TestTimestamps(TestCase):
+    """Log records are stamped with monotonic request, response and sample
+    times."""
+
+    @mock.patch("pylibftdi.Device")
+    def setUp(self, device):
+        self.ecu = me7.ECU()
+        self.ecu._logged_variables = [me7.Variable("foo", 0x00)]
+
+    @mock.patch("me7.ECU._getlogframe", return_value=[0x00, 0x00, 0x01, 0x00])
+    def test_getlogvalues(self, getlogframe):
+        with mock.patch("me7._monotonic_ns", side_effect=[1000, 2000]):
+            variables = self.ecu.getLogValues()
+        self.assertEqual(variables["foo"].get(), 1)
+        self.assertEqual(variables.sent_ns, 1000)
+        self.assertEqual(variables.received_ns, 2000)
+        self.assertTrue(1000 <= variables.sampled_ns <= 2000)
+
+    def test_monotonic_ns(self):
+        # Python 3.6 has no time.monotonic_ns.
+        with mock.patch("time.monotonic", return_value=1.5):
+            self.assertEqual(me7._monotonic_ns_fallback(), 1500000000)
+
+    def test_estimate(self):
+        self.ecu.baudrate = 10000
+        # A 10 byte response takes 10ms to arrive at 10000 baud, and the 3
+        # byte request 3ms to send, leaving 4ms of link delay.
+        self.assertEqual(self.ecu._estimateSampleTime(0, 17000000, 10),
+            17000000 - 10000000 - 2000000)
+
+        # A slower round trip doesn't increase the estimated link delay.
+        self.assertEqual(self.ecu._estimateSampleTime(0, 27000000, 10),
+            27000000 - 10000000 - 2000000)
+
+        # A faster one lowers it.
+        self.assertEqual(self.ecu._estimateSampleTime(0, 15000000, 10),
+            15000000 - 10000000 - 1000000)
+
+    @mock.patch("me7.ECU.sendCommand")
+    @mock.patch("me7.ECU.getresponse")
+    @mock.patch("time.sleep")
+    def test_baudrate_change(self, sleep, getresponse, sendCommand):
+        # The link delay is measured again at a new baud rate.
+        self.ecu._estimateSampleTime(0, 17000000, 10)
+        self.ecu.startdiagsession(38400)
+        self.assertEqual(self.ecu.baudrate, 38400)
+        self.assertEqual(self.ecu._link_delay_ns, None)
+
+    def test_stamped_consumers(self):
+        record = me7.LogRecord(1000000000, 3000000000, 2000000000)
+        record["foo"] = 1
+
+        stats = me7.LogStatistics(window=1, buckets=1)
+        stats.update(record)
+        self.assertEqual(stats.get("foo", now=2.5)["count"], 1)
+        self.assertEqual(stats.get("foo", now=3.5), None)
+
+        path = os.path.join(tempfile.mkdtemp(), "samples")
+        publisher = me7.SamplePublisher(path, [me7.Variable("foo", 0x00)])
+        reader = me7.SampleReader(path)
+        publisher.publish(record)
+        self.assertEqual(reader.latest(), (2.0, {"foo": 1}))
+        reader.close()
+        publisher.close()
+        shutil.rmtree(os.path.dirname(path))